@@ -1,7 +1,7 @@
 # app.py
 """
 App completa actualizada: análisis forrajero + exportes + informe DOCX con recomendaciones
-(técnicas + prácticas regenerativas) y descarga automática.
+(técnicas + prácticas regenerativas) y descarga directa.
 CON VISUALIZACIONES EN MAPAS BASE ESRI
 """
 
@@ -9,19 +9,23 @@ import streamlit as st
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-import tempfile
 import os
 import zipfile
 from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.colors import LinearSegmentedColormap
+from PIL import Image
 import io
-from shapely.geometry import Polygon
+import shapely
+from pyproj import Geod
 import math
-import base64
+import bisect
+import copy
+import functools
+import types
 import hashlib
-import streamlit.components.v1 as components
+import hmac
 
 # Intento importar python-docx
 try:
@@ -41,6 +45,44 @@ except Exception:
     folium = None
     st_folium = None
 
+# pydeck (incluido con Streamlit) como alternativa WebGL cuando no hay folium
+try:
+    import pydeck as pdk
+    PYDECK_AVAILABLE = True
+except Exception:
+    PYDECK_AVAILABLE = False
+    pdk = None
+
+# H3 para dividir el potrero en hexágonos de área uniforme
+try:
+    import h3
+    # La teselación con 'overlap' (bordes cubiertos) existe desde h3 4.2.0
+    H3_AVAILABLE = hasattr(h3, "h3shape_to_cells_experimental")
+except Exception:
+    H3_AVAILABLE = False
+    h3 = None
+
+# PyArrow para GeoParquet en session_state y lectura de archivos vía Arrow
+try:
+    import pyarrow
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+# pyogrio para leer los archivos subidos en bloque (si no está, geopandas usa su motor por defecto)
+try:
+    import pyogrio
+    PYOGRIO_AVAILABLE = True
+except Exception:
+    PYOGRIO_AVAILABLE = False
+    # Sin pyogrio se usa fiona, que trae el driver KML deshabilitado
+    try:
+        import fiona
+        fiona.supported_drivers['KML'] = 'r'
+    except Exception:
+        pass
+OPCIONES_LECTURA = {"engine": "pyogrio", "use_arrow": PYARROW_AVAILABLE} if PYOGRIO_AVAILABLE else {}
+
 # Streamlit config
 st.set_page_config(page_title="🌱 Disponibilidad Forrajera PRV", layout="wide")
 st.title("🌱 Disponibilidad Forrajera PRV — Analizador Forrajero")
@@ -48,14 +90,16 @@ st.markdown("---")
 os.environ['SHAPE_RESTORE_SHX'] = 'YES'
 
 # ---------- AUTENTICACIÓN ----------
+# Digests SHA-256 (bytes) de los usuarios demo, calculados una sola vez al importar
+USUARIOS_DEMO = {
+    "admin": hashlib.sha256("password123".encode()).digest(),
+    "user": hashlib.sha256("user123".encode()).digest(),
+    "tech": hashlib.sha256("tech123".encode()).digest()
+}
+
 def check_authentication():
     """Verifica las credenciales de autenticación"""
-    default_users = {
-        "admin": hashlib.sha256("password123".encode()).hexdigest(),
-        "user": hashlib.sha256("user123".encode()).hexdigest(),
-        "tech": hashlib.sha256("tech123".encode()).hexdigest()
-    }
-    return default_users
+    return USUARIOS_DEMO
 
 def login_section():
     """Sección de login"""
@@ -71,8 +115,8 @@ def login_section():
         
         if submit:
             if username in users_db:
-                hashed_password = hashlib.sha256(password.encode()).hexdigest()
-                if users_db[username] == hashed_password:
+                hashed_password = hashlib.sha256(password.encode()).digest()
+                if hmac.compare_digest(users_db[username], hashed_password):
                     st.session_state.authenticated = True
                     st.session_state.username = username
                     st.success(f"✅ Bienvenido, {username}!")
@@ -94,7 +138,7 @@ def login_section():
 for key in [
     'authenticated', 'username', 'gdf_cargado', 'gdf_analizado', 'mapa_detallado_bytes',
     'docx_buffer', 'analisis_completado', 'html_download_injected', 'mapa_interactivo_analisis',
-    'analisis_ejecutado', 'mostrar_resultados'
+    'analisis_ejecutado', 'mostrar_resultados', 'huella_archivo', 'area_total_ha'
 ]:
     if key not in st.session_state:
         if key == 'authenticated':
@@ -115,7 +159,7 @@ if not st.session_state.authenticated:
 with st.sidebar:
     st.header(f"👋 Bienvenido, {st.session_state.username}")
     
-    if st.button("🚪 Cerrar Sesión"):
+    if st.button("🚪 Cerrar Sesión", key="bt_cerrar_sesion"):
         for key in st.session_state.keys():
             del st.session_state[key]
         st.rerun()
@@ -127,30 +171,34 @@ with st.sidebar:
     base_map_option = st.selectbox(
         "Seleccionar mapa base:",
         ["ESRI Satélite", "ESRI Calles", "ESRI Topográfico", "ESRI Oscuro"],
-        index=0
+        index=0,
+        key="sb_mapa_base"
     )
 
     st.subheader("🛰️ Fuente de Datos Satelitales")
     fuente_satelital = st.selectbox(
         "Seleccionar satélite:",
         ["SENTINEL-2", "LANDSAT-8", "LANDSAT-9", "SIMULADO"],
+        key="sb_fuente_satelital"
     )
 
     tipo_pastura = st.selectbox("Tipo de Pastura:",
-                               ["ALFALFA", "RAYGRASS", "FESTUCA", "AGROPIRRO", "PASTIZAL_NATURAL", "PERSONALIZADO"])
+                               ["ALFALFA", "RAYGRASS", "FESTUCA", "AGROPIRRO", "PASTIZAL_NATURAL", "PERSONALIZADO"],
+                               key="sb_tipo_pastura")
 
     st.subheader("📅 Configuración Temporal")
     fecha_imagen = st.date_input(
         "Fecha de imagen satelital:",
         value=datetime.now() - timedelta(days=30),
-        max_value=datetime.now()
+        max_value=datetime.now(),
+        key="di_fecha_imagen"
     )
-    nubes_max = st.slider("Máximo % de nubes permitido:", 0, 100, 20)
+    nubes_max = st.slider("Máximo % de nubes permitido:", 0, 100, 20, key="sl_nubes_max")
 
     st.subheader("🌿 Parámetros de Detección de Vegetación")
-    umbral_ndvi_minimo = st.slider("Umbral NDVI mínimo vegetación:", 0.05, 0.3, 0.15, 0.01)
-    umbral_ndvi_optimo = st.slider("Umbral NDVI vegetación óptima:", 0.4, 0.8, 0.6, 0.01)
-    sensibilidad_suelo = st.slider("Sensibilidad detección suelo:", 0.1, 1.0, 0.5, 0.1)
+    umbral_ndvi_minimo = st.slider("Umbral NDVI mínimo vegetación:", 0.05, 0.3, 0.15, 0.01, key="sl_ndvi_minimo")
+    umbral_ndvi_optimo = st.slider("Umbral NDVI vegetación óptima:", 0.4, 0.8, 0.6, 0.01, key="sl_ndvi_optimo")
+    sensibilidad_suelo = st.slider("Sensibilidad detección suelo:", 0.1, 1.0, 0.5, 0.1, key="sl_sensibilidad_suelo")
 
     # PARÁMETROS FORRAJEROS POR DEFECTO SEGÚN TIPO DE PASTURA
     if tipo_pastura == "ALFALFA":
@@ -186,64 +234,77 @@ with st.sidebar:
 
     if tipo_pastura == "PERSONALIZADO":
         st.subheader("📊 Parámetros Forrajeros Personalizados")
-        ms_optimo = st.number_input("Biomasa Óptima (kg MS/ha):", min_value=1000, max_value=10000, value=ms_optimo)
-        crecimiento_diario = st.number_input("Crecimiento Diario (kg MS/ha/día):", min_value=10, max_value=300, value=crecimiento_diario)
+        ms_optimo = st.number_input("Biomasa Óptima (kg MS/ha):", min_value=1000, max_value=10000, value=ms_optimo,
+                                    key="ni_ms_optimo")
+        crecimiento_diario = st.number_input("Crecimiento Diario (kg MS/ha/día):", min_value=10, max_value=300, value=crecimiento_diario,
+                                             key="ni_crecimiento_diario")
         consumo_porcentaje = st.number_input("Consumo (% peso vivo):", min_value=0.01, max_value=0.05,
-                                            value=consumo_porcentaje, step=0.001, format="%.3f")
+                                            value=consumo_porcentaje, step=0.001, format="%.3f", key="ni_consumo_porcentaje")
         tasa_utilizacion = st.number_input("Tasa Utilización:", min_value=0.3, max_value=0.8, value=tasa_utilizacion, step=0.01,
-                                          format="%.2f")
+                                          format="%.2f", key="ni_tasa_utilizacion")
 
     st.subheader("📊 Parámetros Ganaderos")
-    peso_promedio = st.slider("Peso promedio animal (kg):", 300, 600, 450)
-    carga_animal = st.slider("Carga animal (cabezas):", 1, 1000, 100)
+    peso_promedio = st.slider("Peso promedio animal (kg):", 300, 600, 450, key="sl_peso_promedio")
+    carga_animal = st.slider("Carga animal (cabezas):", 1, 1000, 100, key="sl_carga_animal")
 
     st.subheader("🎯 División de Potrero")
-    n_divisiones = st.slider("Número de sub-lotes:", min_value=4, max_value=64, value=24)
+    n_divisiones = st.slider("Número de sub-lotes:", min_value=4, max_value=64, value=24, key="sl_n_divisiones")
+    if H3_AVAILABLE:
+        forma_subLotes = st.radio("Forma de los sub-lotes:", ["Rectangular", "Hexagonal (H3)"], horizontal=True,
+                                  key="rd_forma_sublotes")
+    else:
+        forma_subLotes = "Rectangular"
 
     st.subheader("📤 Subir Lote")
     tipo_archivo = st.radio(
         "Formato del archivo:",
         ["Shapefile (ZIP)", "KML"],
-        horizontal=True
+        horizontal=True,
+        key="rd_tipo_archivo"
     )
     if tipo_archivo == "Shapefile (ZIP)":
-        uploaded_file = st.file_uploader("Subir ZIP con shapefile del potrero", type=['zip'])
+        uploaded_file = st.file_uploader("Subir ZIP con shapefile del potrero", type=['zip'], key="fu_zip")
     else:
-        uploaded_file = st.file_uploader("Subir archivo KML del potrero", type=['kml'])
+        uploaded_file = st.file_uploader("Subir archivo KML del potrero", type=['kml'], key="fu_kml")
 
 # -----------------------
 # FUNCIONES DE CARGA
 # -----------------------
 def cargar_shapefile_desde_zip(uploaded_zip):
     try:
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            zip_path = os.path.join(tmp_dir, "upload.zip")
-            with open(zip_path, "wb") as f:
-                f.write(uploaded_zip.getvalue())
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(tmp_dir)
-            shp_files = [f for f in os.listdir(tmp_dir) if f.lower().endswith('.shp')]
-            if shp_files:
-                shp_path = os.path.join(tmp_dir, shp_files[0])
-                gdf = gpd.read_file(shp_path)
-                if gdf.crs is None:
-                    gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
-                return gdf
-            else:
-                st.error("❌ No se encontró archivo .shp en el ZIP")
-                return None
+        datos = uploaded_zip.getvalue()
+        with zipfile.ZipFile(io.BytesIO(datos)) as zip_ref:
+            # Primer .shp del ZIP (se detiene en cuanto lo encuentra)
+            shp = next((n for n in zip_ref.namelist()
+                        if n.lower().endswith('.shp') and not n.startswith('__MACOSX/')), None)
+            if shp and '/' in shp:
+                # GDAL solo ve las capas de la raíz del ZIP: se re-empaquetan en memoria
+                # los archivos del shapefile que está dentro de una carpeta
+                base = shp[:-4]
+                plano = io.BytesIO()
+                with zipfile.ZipFile(plano, 'w', zipfile.ZIP_STORED) as zip_plano:
+                    for n in zip_ref.namelist():
+                        if os.path.splitext(n)[0] == base:
+                            zip_plano.writestr(os.path.basename(n), zip_ref.read(n))
+                datos = plano.getvalue()
+        if shp:
+            # El ZIP se lee directamente desde memoria, sin archivos temporales
+            capa = os.path.splitext(os.path.basename(shp))[0]
+            gdf = gpd.read_file(io.BytesIO(datos), layer=capa, **OPCIONES_LECTURA)
+            if gdf.crs is None:
+                gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
+            return gdf
+        else:
+            st.error("❌ No se encontró archivo .shp en el ZIP")
+            return None
     except Exception as e:
         st.error(f"❌ Error cargando shapefile: {e}")
         return None
 
 def cargar_kml(uploaded_kml):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.kml') as tmp_file:
-            tmp_file.write(uploaded_kml.getvalue())
-            tmp_file.flush()
-            tmp_path = tmp_file.name
-        gdf = gpd.read_file(tmp_path, driver='KML')
-        os.unlink(tmp_path)
+        # Igual que el shapefile: el KML se lee desde memoria
+        gdf = gpd.read_file(io.BytesIO(uploaded_kml.getvalue()), **OPCIONES_LECTURA)
         if not gdf.empty and gdf.crs is None:
             gdf.set_crs(epsg=4326, inplace=True, allow_override=True)
         return gdf
@@ -251,6 +312,46 @@ def cargar_kml(uploaded_kml):
         st.error(f"❌ Error cargando KML: {e}")
         return None
 
+# -----------------------
+# UTILIDADES DE CACHÉ
+# -----------------------
+def hash_gdf(gdf):
+    """Huella estable de un GeoDataFrame (geometría en WKB + atributos) para las cachés de Streamlit"""
+    huella = hashlib.md5(pd.util.hash_pandas_object(gdf.to_wkb(), index=True).values.tobytes())
+    huella.update(f"{list(gdf.columns)}|{gdf.crs}".encode())
+    return huella.hexdigest()
+
+def empaquetar_gdf(gdf):
+    """Serializa un GeoDataFrame a GeoParquet en memoria (geometría WKB + zstd) para guardarlo en session_state"""
+    if not PYARROW_AVAILABLE:
+        return gdf
+    buf = io.BytesIO()
+    gdf.to_parquet(buf, compression='zstd')
+    return buf.getvalue()
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def desempaquetar_gdf(datos):
+    """Reconstruye (una vez por contenido) el GeoDataFrame guardado con empaquetar_gdf.
+       El índice espacial (R-tree) se construye acá, así queda cacheado junto con el objeto."""
+    gdf = gpd.read_parquet(io.BytesIO(datos))
+    _ = gdf.sindex
+    return gdf
+
+def obtener_gdf_sesion(clave):
+    """GeoDataFrame guardado en session_state[clave] con empaquetar_gdf (o None)"""
+    datos = st.session_state[clave]
+    if isinstance(datos, bytes):
+        return desempaquetar_gdf(datos)
+    return datos
+
+def obtener_gdf_cargado():
+    """GeoDataFrame del lote cargado en la sesión (o None)"""
+    return obtener_gdf_sesion('gdf_cargado')
+
+def obtener_gdf_analizado():
+    """GeoDataFrame analizado de la sesión (o None)"""
+    return obtener_gdf_sesion('gdf_analizado')
+
 # -----------------------
 # UTILIDADES FORRAJERAS
 # -----------------------
@@ -267,278 +368,412 @@ PARAMETROS_FORRAJEROS_BASE = {
                          'TASA_UTILIZACION_RECOMENDADA': 0.45}
 }
 
+@functools.lru_cache(maxsize=32)
+def _parametros_forrajeros_base(tipo_pastura):
+    """Parámetros de las pasturas estándar (inmutables, se resuelven una sola vez por tipo)"""
+    return types.MappingProxyType(
+        PARAMETROS_FORRAJEROS_BASE.get(tipo_pastura, PARAMETROS_FORRAJEROS_BASE['PASTIZAL_NATURAL'])
+    )
+
+@functools.lru_cache(maxsize=32)
+def _parametros_forrajeros_personalizados(ms_optimo, crecimiento_diario, consumo_porcentaje, tasa_utilizacion):
+    """Parámetros de PERSONALIZADO, cacheados por los valores del sidebar (cambian solo si el usuario los edita)"""
+    return types.MappingProxyType({
+        'MS_POR_HA_OPTIMO': ms_optimo,
+        'CRECIMIENTO_DIARIO': crecimiento_diario,
+        'CONSUMO_PORCENTAJE_PESO': consumo_porcentaje,
+        'TASA_UTILIZACION_RECOMENDADA': tasa_utilizacion
+    })
+
 def obtener_parametros_forrajeros(tipo_pastura):
     if tipo_pastura == "PERSONALIZADO":
-        return {
-            'MS_POR_HA_OPTIMO': ms_optimo,
-            'CRECIMIENTO_DIARIO': crecimiento_diario,
-            'CONSUMO_PORCENTAJE_PESO': consumo_porcentaje,
-            'TASA_UTILIZACION_RECOMENDADA': tasa_utilizacion
-        }
+        # Los valores actuales del sidebar forman parte de la clave de la caché
+        return _parametros_forrajeros_personalizados(ms_optimo, crecimiento_diario, consumo_porcentaje, tasa_utilizacion)
     else:
-        return PARAMETROS_FORRAJEROS_BASE.get(tipo_pastura, PARAMETROS_FORRAJEROS_BASE['PASTIZAL_NATURAL'])
+        return _parametros_forrajeros_base(tipo_pastura)
 
 def calcular_superficie(gdf):
+    """Superficie en ha (array de NumPy alineado con las filas de gdf). En coordenadas geográficas
+       se usa el área geodésica sobre el elipsoide (sin reproyectar vértices); en CRS proyectados, el área plana."""
     try:
         if gdf.crs is None or gdf.crs.is_geographic:
-            gdf_m = gdf.to_crs(epsg=3857)
-            area_m2 = gdf_m.geometry.area
-        else:
-            area_m2 = gdf.geometry.area
-        return area_m2 / 10000.0
+            geod = gdf.crs.get_geod() if gdf.crs is not None else Geod(ellps="WGS84")
+            area_m2 = np.fromiter(
+                (abs(geod.geometry_area_perimeter(g)[0]) if g is not None else 0.0 for g in gdf.geometry),
+                dtype=float, count=len(gdf)
+            )
+            return area_m2 / 10000.0
+        return gdf.geometry.area.to_numpy() / 10000.0
     except Exception:
         try:
-            return gdf.geometry.area / 10000.0
+            return gdf.geometry.area.to_numpy() / 10000.0
         except Exception:
-            return pd.Series([0]*len(gdf), index=gdf.index)
+            return np.zeros(len(gdf))
 
 def dividir_potrero_en_subLotes(gdf, n_zonas):
     if gdf is None or len(gdf) == 0:
         return gdf
     potrero = gdf.iloc[0].geometry
     minx, miny, maxx, maxy = potrero.bounds
-    sub_poligonos = []
-    n_cols = math.ceil(math.sqrt(n_zonas))
+    n_cols = math.isqrt(n_zonas)
+    n_cols += n_cols * n_cols < n_zonas  # techo exacto de la raíz, sin redondeo de coma flotante
     n_rows = math.ceil(n_zonas / n_cols)
     width = (maxx - minx) / n_cols
     height = (maxy - miny) / n_rows
-    for i in range(n_rows):
-        for j in range(n_cols):
-            if len(sub_poligonos) >= n_zonas:
-                break
-            cell_minx = minx + j * width
-            cell_maxx = minx + (j + 1) * width
-            cell_miny = miny + i * height
-            cell_maxy = miny + (i + 1) * height
-            cell = Polygon([
-                (cell_minx, cell_miny),
-                (cell_maxx, cell_miny),
-                (cell_maxx, cell_maxy),
-                (cell_minx, cell_maxy)
-            ])
-            inter = potrero.intersection(cell)
-            if not inter.is_empty and inter.area > 0:
-                sub_poligonos.append(inter)
-    if sub_poligonos:
-        nuevo = gpd.GeoDataFrame({'id_subLote': range(1, len(sub_poligonos)+1), 'geometry': sub_poligonos})
-        nuevo.crs = gdf.crs
-        return nuevo
-    return gdf
+    # Todas las celdas de la grilla (fila por fila) se crean en una sola llamada vectorizada;
+    # los bordes se calculan una vez, así celdas vecinas comparten exactamente la misma coordenada
+    xs = minx + np.arange(n_cols + 1) * width
+    ys = miny + np.arange(n_rows + 1) * height
+    celda_minx, celda_miny = np.meshgrid(xs[:-1], ys[:-1])
+    celda_maxx, celda_maxy = np.meshgrid(xs[1:], ys[1:])
+    celdas = shapely.box(celda_minx.ravel(), celda_miny.ravel(), celda_maxx.ravel(), celda_maxy.ravel())
+    # El STRtree descarta las celdas fuera del potrero; las contenidas por completo no se recortan
+    arbol = shapely.STRtree([potrero])
+    candidatas = np.unique(arbol.query(celdas, predicate='intersects')[0])
+    contenidas = np.unique(arbol.query(celdas[candidatas], predicate='within')[0])
+    contenidas = candidatas[contenidas]
+    recortar = np.setdiff1d(candidatas, contenidas)
+    inter = np.full(len(celdas), None, dtype=object)
+    inter[contenidas] = celdas[contenidas]
+    inter[recortar] = shapely.intersection(celdas[recortar], potrero)
+    mask = ~shapely.is_empty(inter) & (shapely.area(inter) > 0)
+    sub_poligonos = inter[mask][:n_zonas]
+    if len(sub_poligonos) > 0:
+        return gpd.GeoDataFrame({'id_subLote': np.arange(1, len(sub_poligonos)+1, dtype=np.int32)},
+                                geometry=gpd.GeoSeries(sub_poligonos, crs=gdf.crs))
+    # Copia: el lote de entrada es el objeto compartido por la caché y el análisis le agrega columnas
+    return gdf.copy()
+
+def dividir_potrero_en_hexagonos(gdf, n_zonas):
+    """Divide el potrero en hexágonos H3 de área uniforme. La resolución se elige para obtener
+       la cantidad de celdas más cercana a n_zonas; los hexágonos del borde se recortan al potrero."""
+    if gdf is None or len(gdf) == 0:
+        return gdf
+    gdf_wgs84 = gdf.to_crs(epsg=4326) if gdf.crs is not None and not gdf.crs.equals("EPSG:4326") else gdf
+    potrero = gdf_wgs84.iloc[0].geometry
+    forma = h3.geo_to_h3shape(potrero.__geo_interface__)
+    # Se afina la resolución hasta alcanzar n_zonas celdas y se queda con la más cercana
+    # ('overlap' incluye los hexágonos del borde, así la teselación cubre todo el potrero)
+    celdas = []
+    for resolucion in range(16):
+        anteriores = celdas
+        celdas = h3.h3shape_to_cells_experimental(forma, resolucion, contain='overlap')
+        if len(celdas) >= n_zonas:
+            if anteriores and n_zonas - len(anteriores) < len(celdas) - n_zonas:
+                celdas = anteriores
+            break
+    celdas = sorted(celdas)
+    hexagonos = np.array([shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(c)]) for c in celdas])
+    inter = shapely.intersection(hexagonos, potrero)
+    mask = ~shapely.is_empty(inter) & (shapely.area(inter) > 0)
+    sub_poligonos = inter[mask]
+    if len(sub_poligonos) > 0:
+        nuevo = gpd.GeoDataFrame({'id_subLote': np.arange(1, len(sub_poligonos)+1, dtype=np.int32)},
+                                 geometry=gpd.GeoSeries(sub_poligonos, crs=gdf_wgs84.crs))
+        return nuevo.to_crs(gdf.crs) if gdf.crs is not None else nuevo
+    return gdf.copy()
 
 # -----------------------
 # DETECCIÓN / SIMULACIÓN
 # -----------------------
 class DetectorVegetacionRealista:
+    # Cortes de NDVI y categorías en orden creciente: el código int8 de cada sub-lote es su posición en CATEGORIAS
+    UMBRALES_NDVI = np.array([0.12, 0.22, 0.4, 0.65])
+    CATEGORIAS = np.array(["SUELO_DESNUDO", "SUELO_PARCIAL", "VEGETACION_ESCASA", "VEGETACION_MODERADA",
+                           "VEGETACION_DENSA"])
+    COBERTURAS = np.array([0.05, 0.25, 0.5, 0.75, 0.9])
+    CODIGO_CATEGORIA = {c: i for i, c in enumerate(CATEGORIAS)}
+    # Coeficientes de biomasa por categoría (mismo orden): fracción del óptimo con tope, factor de
+    # crecimiento y calidad. SUELO_DESNUDO (código 0) usa valores fijos.
+    FRACCION_BIOMASA = np.array([0.0, 0.05, 0.3, 0.6, 0.9])
+    TOPE_BIOMASA = np.array([20, 200, 1200, 3000, 6000])
+    FACTOR_CRECIMIENTO = np.array([0.0, 0.2, 0.4, 0.7, 0.9])
+    FACTOR_CALIDAD = np.array([0.2, 0.3, 0.5, 0.7, 0.85])
+    BIOMASA_SUELO_DESNUDO = 20
+    CRECIMIENTO_SUELO_DESNUDO = 1
+
     def __init__(self, umbral_ndvi_minimo=0.15, umbral_ndvi_optimo=0.6, sensibilidad_suelo=0.5):
         self.umbral_ndvi_minimo = umbral_ndvi_minimo
         self.umbral_ndvi_optimo = umbral_ndvi_optimo
         self.sensibilidad_suelo = sensibilidad_suelo
 
     def clasificar_vegetacion_realista(self, ndvi, evi, savi, bsi, ndbi, msavi2=None):
-        if ndvi < 0.12:
-            return "SUELO_DESNUDO", 0.05
-        elif ndvi < 0.22:
-            return "SUELO_PARCIAL", 0.25
-        elif ndvi < 0.4:
-            return "VEGETACION_ESCASA", 0.5
-        elif ndvi < 0.65:
-            return "VEGETACION_MODERADA", 0.75
-        else:
-            return "VEGETACION_DENSA", 0.9
+        # Misma tabla que la versión por lote: el corte se busca con bisect sobre UMBRALES_NDVI
+        i = bisect.bisect_right(self.UMBRALES_NDVI, ndvi)
+        return str(self.CATEGORIAS[i]), float(self.COBERTURAS[i])
 
     def calcular_biomasa_realista(self, ndvi, evi, savi, categoria, cobertura, params):
-        base = params['MS_POR_HA_OPTIMO']
-        if categoria == "SUELO_DESNUDO":
-            return 20, 1, 0.2
-        if categoria == "SUELO_PARCIAL":
-            return min(base * 0.05, 200), params['CRECIMIENTO_DIARIO'] * 0.2, 0.3
-        if categoria == "VEGETACION_ESCASA":
-            return min(base * 0.3, 1200), params['CRECIMIENTO_DIARIO'] * 0.4, 0.5
-        if categoria == "VEGETACION_MODERADA":
-            return min(base * 0.6, 3000), params['CRECIMIENTO_DIARIO'] * 0.7, 0.7
-        return min(base * 0.9, 6000), params['CRECIMIENTO_DIARIO'] * 0.9, 0.85
-
-def simular_patrones_reales_con_suelo(id_subLote, x_norm, y_norm, fuente_satelital):
+        codigo = np.array([self.CODIGO_CATEGORIA.get(categoria, len(self.CATEGORIAS) - 1)])
+        biomasa, crecimiento, calidad = self.calcular_biomasa_lote(codigo, params)
+        return float(biomasa[0]), float(crecimiento[0]), float(calidad[0])
+
+    @classmethod
+    def clasificar_vegetacion_lote(cls, ndvi):
+        """Versión vectorizada de clasificar_vegetacion_realista: devuelve (códigos int8, coberturas).
+           Las etiquetas se obtienen recién al mostrar, con CATEGORIAS[códigos]."""
+        codigos = np.searchsorted(cls.UMBRALES_NDVI, ndvi, side='right').astype(np.int8)
+        return codigos, cls.COBERTURAS[codigos]
+
+    @classmethod
+    def calcular_biomasa_lote(cls, codigos, params):
+        """Versión vectorizada de calcular_biomasa_realista: devuelve (biomasa, crecimiento, calidad) como arrays"""
+        suelo_desnudo = codigos == 0
+        biomasa = np.where(suelo_desnudo, cls.BIOMASA_SUELO_DESNUDO,
+                           np.minimum(params['MS_POR_HA_OPTIMO'] * cls.FRACCION_BIOMASA[codigos], cls.TOPE_BIOMASA[codigos]))
+        crecimiento_diario = np.where(suelo_desnudo, cls.CRECIMIENTO_SUELO_DESNUDO,
+                                      params['CRECIMIENTO_DIARIO'] * cls.FACTOR_CRECIMIENTO[codigos])
+        return biomasa, crecimiento_diario, cls.FACTOR_CALIDAD[codigos]
+
+GENERADOR_ALEATORIO = np.random.default_rng()
+
+def simular_patrones_reales_con_suelo(id_subLote, x_norm, y_norm, fuente_satelital, rng=None):
+    """Simula los índices espectrales de todos los sub-lotes a la vez (acepta arrays)"""
+    rng = GENERADOR_ALEATORIO if rng is None else rng
+    id_subLote = np.asarray(id_subLote)
     base = 0.2 + 0.4 * ((id_subLote % 6) / 6)
-    ndvi = max(0.05, min(0.85, base + np.random.normal(0, 0.05)))
-    if ndvi < 0.15:
-        evi = ndvi * 0.8
-        savi = ndvi * 0.9
-        bsi = 0.6
-        ndbi = 0.25
-    elif ndvi < 0.3:
-        evi = ndvi * 1.1
-        savi = ndvi * 1.05
-        bsi = 0.4
-        ndbi = 0.15
-    elif ndvi < 0.5:
-        evi = ndvi * 1.3
-        savi = ndvi * 1.2
-        bsi = 0.1
-        ndbi = 0.05
-    else:
-        evi = ndvi * 1.4
-        savi = ndvi * 1.3
-        bsi = -0.1
-        ndbi = -0.05
+    ndvi = np.clip(base + rng.normal(0.0, 0.05, size=id_subLote.shape), 0.05, 0.85)
+    # Banda de NDVI de cada sub-lote (0..3) y coeficientes por banda en tablas de búsqueda
+    banda = np.digitize(ndvi, [0.15, 0.3, 0.5])
+    evi = ndvi * np.array([0.8, 1.1, 1.3, 1.4])[banda]
+    savi = ndvi * np.array([0.9, 1.05, 1.2, 1.3])[banda]
+    bsi = np.array([0.6, 0.4, 0.1, -0.1])[banda]
+    ndbi = np.array([0.25, 0.15, 0.05, -0.05])[banda]
     msavi2 = ndvi * 1.0
     return ndvi, evi, savi, bsi, ndbi, msavi2
 
+# Cortes de biomasa disponible (kg MS/ha) para el estado forrajero 0..4
+CORTES_ESTADO_FORRAJERO = np.array([200, 600, 1200, 2000])
+
 def calcular_metricas_ganaderas(gdf_analizado, tipo_pastura, peso_promedio, carga_animal):
+    """Calcula las métricas ganaderas por sub-lote y las devuelve como un dict de columnas (arrays)"""
     params = obtener_parametros_forrajeros(tipo_pastura)
-    metricas = []
-    for idx, row in gdf_analizado.iterrows():
-        biomasa_disponible = row.get('biomasa_disponible_kg_ms_ha', 0)
-        area_ha = row.get('area_ha', 0)
-        consumo_individual_kg = peso_promedio * params['CONSUMO_PORCENTAJE_PESO']
-        biomasa_total_disponible = biomasa_disponible * area_ha
-        if biomasa_total_disponible > 0 and consumo_individual_kg > 0:
-            ev_por_dia = biomasa_total_disponible * 0.001 / consumo_individual_kg
-            ev_soportable = ev_por_dia / params['TASA_UTILIZACION_RECOMENDADA']
-            ev_soportable = max(0.01, ev_soportable)
+    n = len(gdf_analizado)
+    consumo_individual_kg = peso_promedio * params['CONSUMO_PORCENTAJE_PESO']
+    biomasas = (gdf_analizado['biomasa_disponible_kg_ms_ha'].to_numpy(dtype=np.float64)
+                if 'biomasa_disponible_kg_ms_ha' in gdf_analizado.columns else np.zeros(n))
+    areas = gdf_analizado['area_ha'].to_numpy(dtype=np.float64) if 'area_ha' in gdf_analizado.columns else np.zeros(n)
+    biomasa_total = biomasas * areas
+    # Todas las métricas se calculan como operaciones de arrays (sin bucle por sub-lote)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if consumo_individual_kg > 0:
+            ev_soportable = np.where(
+                biomasa_total > 0,
+                np.maximum(0.01, biomasa_total * 0.001 / consumo_individual_kg / params['TASA_UTILIZACION_RECOMENDADA']),
+                0.01
+            )
         else:
-            ev_soportable = 0.01
-        if ev_soportable > 0 and area_ha > 0:
-            ev_ha = ev_soportable / area_ha
-            ev_ha_display = ev_ha
-        else:
-            ev_ha_display = 0.01
-        if carga_animal > 0:
-            consumo_total_diario = carga_animal * consumo_individual_kg
-            if consumo_total_diario > 0 and biomasa_total_disponible > 0:
-                dias_permanencia = biomasa_total_disponible / consumo_total_diario
-                dias_permanencia = min(max(dias_permanencia, 0.1), 365)
-            else:
-                dias_permanencia = 0.1
+            ev_soportable = np.full(n, 0.01)
+        ev_ha = np.where((ev_soportable > 0) & (areas > 0), ev_soportable / areas, 0.01)
+        consumo_total_diario = carga_animal * consumo_individual_kg
+        if carga_animal > 0 and consumo_total_diario > 0:
+            dias_permanencia = np.where(
+                biomasa_total > 0,
+                np.clip(biomasa_total / consumo_total_diario, 0.1, 365),
+                0.1
+            )
         else:
-            dias_permanencia = 0.1
-        if biomasa_disponible >= 2000:
-            estado_forrajero = 4
-        elif biomasa_disponible >= 1200:
-            estado_forrajero = 3
-        elif biomasa_disponible >= 600:
-            estado_forrajero = 2
-        elif biomasa_disponible >= 200:
-            estado_forrajero = 1
-        else:
-            estado_forrajero = 0
-        metricas.append({
-            'ev_soportable': round(ev_soportable, 2),
-            'dias_permanencia': round(dias_permanencia, 1),
-            'tasa_utilizacion': round(min(1.0, (carga_animal * consumo_individual_kg) / max(1, biomasa_total_disponible)), 3) if biomasa_total_disponible>0 else 0,
-            'biomasa_total_kg': round(biomasa_total_disponible, 1),
-            'consumo_individual_kg': round(consumo_individual_kg, 1),
-            'estado_forrajero': estado_forrajero,
-            'ev_ha': round(ev_ha_display, 3)
-        })
-    return metricas
+            dias_permanencia = np.full(n, 0.1)
+        tasa_utilizacion = np.where(
+            biomasa_total > 0,
+            np.round(np.minimum(1.0, consumo_total_diario / np.maximum(1, biomasa_total)), 3),
+            0
+        )
+    estado_forrajero = np.searchsorted(CORTES_ESTADO_FORRAJERO, biomasas, side='right').astype(np.int8)
+    return {
+        'ev_soportable': np.round(ev_soportable, 2),
+        'dias_permanencia': np.round(dias_permanencia, 1),
+        'tasa_utilizacion': tasa_utilizacion,
+        'biomasa_total_kg': np.round(biomasa_total, 1),
+        'consumo_individual_kg': np.full(n, round(consumo_individual_kg, 1)),
+        'estado_forrajero': estado_forrajero,
+        'ev_ha': np.round(ev_ha, 3)
+    }
 
 def calcular_indices_forrajeros_realista(gdf, tipo_pastura, fuente_satelital, fecha_imagen, nubes_max,
                                        umbral_ndvi_minimo=0.15, umbral_ndvi_optimo=0.6, sensibilidad_suelo=0.5):
     try:
-        resultados = []
         params = obtener_parametros_forrajeros(tipo_pastura)
         detector = DetectorVegetacionRealista(umbral_ndvi_minimo, umbral_ndvi_optimo, sensibilidad_suelo)
-        gdf_centroids = gdf.copy()
-        gdf_centroids['centroid'] = gdf_centroids.geometry.centroid
-        gdf_centroids['x'] = gdf_centroids.centroid.x
-        gdf_centroids['y'] = gdf_centroids.centroid.y
-        x_coords = gdf_centroids['x'].tolist()
-        y_coords = gdf_centroids['y'].tolist()
-        x_min, x_max = min(x_coords), max(x_coords)
-        y_min, y_max = min(y_coords), max(y_coords)
+        # Centroides en una sola llamada vectorizada (sin copiar el GeoDataFrame)
+        centroides = gdf.geometry.centroid
+        x = centroides.x.to_numpy()
+        y = centroides.y.to_numpy()
+        x_min, x_max = x.min(), x.max()
+        y_min, y_max = y.min(), y.max()
         st.info("🔍 Aplicando detección REALISTA (simulada) ...")
-        for idx, row in gdf_centroids.iterrows():
-            id_subLote = row.get('id_subLote', idx+1)
-            x_norm = (row['x'] - x_min) / (x_max - x_min) if x_max!=x_min else 0.5
-            y_norm = (row['y'] - y_min) / (y_max - y_min) if y_max!=y_min else 0.5
-            ndvi, evi, savi, bsi, ndbi, msavi2 = simular_patrones_reales_con_suelo(id_subLote, x_norm, y_norm, fuente_satelital)
-            categoria, cobertura = detector.clasificar_vegetacion_realista(ndvi, evi, savi, bsi, ndbi, msavi2)
-            biomasa_ms_ha, crecimiento_diario, calidad = detector.calcular_biomasa_realista(ndvi, evi, savi, categoria, cobertura, params)
-            if categoria == "SUELO_DESNUDO":
-                biomasa_disponible = 20
-            elif categoria == "SUELO_PARCIAL":
-                biomasa_disponible = 80
-            else:
-                biomasa_disponible = max(20, min(4000, biomasa_ms_ha * calidad * cobertura))
-            resultados.append({
-                'id_subLote': id_subLote,
-                'ndvi': round(float(ndvi),3),
-                'evi': round(float(evi),3),
-                'savi': round(float(savi),3),
-                'msavi2': round(float(msavi2),3),
-                'bsi': round(float(bsi),3),
-                'ndbi': round(float(ndbi),3),
-                'cobertura_vegetal': round(cobertura,3),
-                'tipo_superficie': categoria,
-                'biomasa_ms_ha': round(biomasa_ms_ha,1),
-                'biomasa_disponible_kg_ms_ha': round(biomasa_disponible,1),
-                'crecimiento_diario': round(crecimiento_diario,1),
-                'factor_calidad': round(calidad,3),
-                'fuente_datos': fuente_satelital,
-                'x_norm': round(x_norm,3),
-                'y_norm': round(y_norm,3)
-            })
+        # Todos los sub-lotes se procesan a la vez con operaciones vectorizadas
+        if 'id_subLote' in gdf.columns:
+            ids = gdf['id_subLote'].to_numpy()
+        else:
+            ids = np.arange(len(gdf)) + 1
+        x_norm = (x - x_min) / (x_max - x_min) if x_max != x_min else np.full(len(x), 0.5)
+        y_norm = (y - y_min) / (y_max - y_min) if y_max != y_min else np.full(len(y), 0.5)
+        ndvi, evi, savi, bsi, ndbi, msavi2 = simular_patrones_reales_con_suelo(ids, x_norm, y_norm, fuente_satelital)
+        codigos, cobertura = detector.clasificar_vegetacion_lote(ndvi)
+        biomasa_ms_ha, crecimiento_diario, calidad = detector.calcular_biomasa_lote(codigos, params)
+        biomasa_disponible = np.select(
+            [codigos == 0, codigos == 1],  # SUELO_DESNUDO, SUELO_PARCIAL
+            [20, 80],
+            np.clip(biomasa_ms_ha * calidad * cobertura, 20, 4000)
+        )
+        resultados = pd.DataFrame({
+            'id_subLote': ids,
+            'ndvi': np.round(ndvi, 3),
+            'evi': np.round(evi, 3),
+            'savi': np.round(savi, 3),
+            'msavi2': np.round(msavi2, 3),
+            'bsi': np.round(bsi, 3),
+            'ndbi': np.round(ndbi, 3),
+            'cobertura_vegetal': np.round(cobertura, 3),
+            'tipo_superficie': detector.CATEGORIAS[codigos],
+            'biomasa_ms_ha': np.round(biomasa_ms_ha, 1),
+            'biomasa_disponible_kg_ms_ha': np.round(biomasa_disponible, 1),
+            'crecimiento_diario': np.round(crecimiento_diario, 1),
+            'factor_calidad': np.round(calidad, 3),
+            'fuente_datos': fuente_satelital,
+            'x_norm': np.round(x_norm, 3),
+            'y_norm': np.round(y_norm, 3)
+        })
         st.success("✅ Cálculo de índices completado.")
         return resultados
     except Exception as e:
         st.error(f"❌ Error en índices: {e}")
         import traceback
         st.error(traceback.format_exc())
-        return []
+        return pd.DataFrame()
+
+@st.cache_data(show_spinner=False, max_entries=16, hash_funcs={gpd.GeoDataFrame: hash_gdf})
+def ejecutar_analisis_forrajero(gdf_input, n_divisiones, forma_subLotes, tipo_pastura, parametros, fuente_satelital, fecha_imagen,
+                                nubes_max, umbral_ndvi_minimo, umbral_ndvi_optimo, sensibilidad_suelo,
+                                peso_promedio, carga_animal):
+    """División en sub-lotes + índices + métricas ganaderas. Cacheado por geometría y configuración,
+       así un rerun con las mismas entradas no repite el cálculo. `parametros` solo entra en la clave
+       de caché (para PERSONALIZADO dependen de los valores del sidebar). Devuelve (gdf, mensaje_error)."""
+    # 1. Dividir potrero en sub-lotes
+    st.info("📐 Dividiendo potrero en sub-lotes...")
+    if forma_subLotes == "Hexagonal (H3)" and H3_AVAILABLE:
+        gdf_sub = dividir_potrero_en_hexagonos(gdf_input, n_divisiones)
+    else:
+        gdf_sub = dividir_potrero_en_subLotes(gdf_input, n_divisiones)
+    if gdf_sub is None or len(gdf_sub)==0:
+        return None, "No se pudo dividir el potrero en sub-lotes."
+
+    # 2. Calcular áreas
+    gdf_sub['area_ha'] = calcular_superficie(gdf_sub)
+
+    # 3. Calcular índices de vegetación
+    st.info("🌿 Calculando índices de vegetación...")
+    indices = calcular_indices_forrajeros_realista(gdf_sub, tipo_pastura, fuente_satelital, fecha_imagen, nubes_max,
+                                                  umbral_ndvi_minimo, umbral_ndvi_optimo, sensibilidad_suelo)
+    if indices.empty:
+        return None, "No se pudieron calcular índices (indices vacío)."
+
+    # 4. Agregar índices al GeoDataFrame
+    # (una asignación por columna en lugar de una por celda)
+    df_indices = indices.drop(columns=['id_subLote'], errors='ignore')
+    gdf_sub = gdf_sub.assign(**{k: df_indices[k].to_numpy() for k in df_indices.columns})
+
+    # 5. Calcular métricas ganaderas
+    st.info("🐄 Calculando métricas ganaderas...")
+    metricas = calcular_metricas_ganaderas(gdf_sub, tipo_pastura, peso_promedio, carga_animal)
+    return gdf_sub.assign(**metricas), None
 
 # -----------------------
 # MAPAS INTERACTIVOS CON ESRI
 # -----------------------
+# Mapas base de ESRI (URL y atribución), definidos una sola vez al importar
+TILES_ESRI = {
+    "ESRI Satélite": {
+        "url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        "attr": "Esri, Maxar, Earthstar Geographics"
+    },
+    "ESRI Calles": {
+        "url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}",
+        "attr": "Esri, HERE, Garmin"
+    },
+    "ESRI Topográfico": {
+        "url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{z}/{y}/{x}",
+        "attr": "Esri, HERE, Garmin"
+    },
+    "ESRI Oscuro": {
+        "url": "https://server.arcgisonline.com/ArcGIS/rest/services/Canvas/World_Dark_Gray_Base/MapServer/tile/{z}/{y}/{x}",
+        "attr": "Esri, HERE, Garmin"
+    }
+}
+
 def obtener_tiles_esri(base_map_name):
     """Devuelve la URL y atribución para los mapas base de ESRI"""
-    esri_tiles = {
-        "ESRI Satélite": {
-            "url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-            "attr": "Esri, Maxar, Earthstar Geographics"
-        },
-        "ESRI Calles": {
-            "url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}",
-            "attr": "Esri, HERE, Garmin"
-        },
-        "ESRI Topográfico": {
-            "url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{z}/{y}/{x}",
-            "attr": "Esri, HERE, Garmin"
-        },
-        "ESRI Oscuro": {
-            "url": "https://server.arcgisonline.com/ArcGIS/rest/services/Canvas/World_Dark_Gray_Base/MapServer/tile/{z}/{y}/{x}",
-            "attr": "Esri, HERE, Garmin"
-        }
-    }
-    return esri_tiles.get(base_map_name, esri_tiles["ESRI Satélite"])
+    return TILES_ESRI.get(base_map_name, TILES_ESRI["ESRI Satélite"])
 
-def crear_mapa_interactivo_base(gdf, base_map_name="ESRI Satélite"):
-    """Crea un mapa base interactivo con ESRI"""
-    if not FOLIUM_AVAILABLE or gdf is None or len(gdf)==0:
-        return None
-    
-    bounds = gdf.total_bounds
-    centroid = gdf.geometry.centroid.iloc[0]
-    m = folium.Map(location=[centroid.y, centroid.x], tiles=None, control_scale=True, zoom_start=12)
-    
-    # Añadir mapa base ESRI
+def crear_mapa_esri(base_map_name, bounds, zoom_start):
+    """Mapa folium vacío centrado en los límites dados, con la capa base ESRI elegida.
+       Los vectores se dibujan en canvas (prefer_canvas) en lugar de un nodo SVG por sub-lote."""
+    m = folium.Map(location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2], tiles=None,
+                   control_scale=True, zoom_start=zoom_start, prefer_canvas=True)
     tiles_config = obtener_tiles_esri(base_map_name)
     folium.TileLayer(
         tiles=tiles_config["url"],
         attr=tiles_config["attr"],
         name=base_map_name
     ).add_to(m)
+    return m
+
+# Paleta común (rojo → verde) y cortes de clase para los mapas de análisis
+PALETA_ANALISIS = np.array(['#d73027', '#fdae61', '#fee08b', '#a6d96a', '#1a9850'])
+CORTES_ANALISIS = {
+    "biomasa": ('biomasa_disponible_kg_ms_ha', [200, 600, 1200, 2000]),
+    "ndvi": ('ndvi', [0.2, 0.4, 0.6, 0.7]),
+    "ev_ha": ('ev_ha', [0.5, 1.0, 1.5, 2.0])
+}
+COLORES_TIPO_SUPERFICIE = {
+    'SUELO_DESNUDO': '#d73027',
+    'SUELO_PARCIAL': '#fdae61',
+    'VEGETACION_ESCASA': '#fee08b',
+    'VEGETACION_MODERADA': '#a6d96a',
+    'VEGETACION_DENSA': '#1a9850'
+}
+
+# Tooltip y leyenda estáticos: se construyen una sola vez al importar
+CAMPOS_TOOLTIP_ANALISIS = ['id_subLote', 'area_ha', 'tipo_superficie', 'ndvi', 'biomasa_disponible_kg_ms_ha', 'ev_ha', 'dias_permanencia']
+ALIAS_TOOLTIP_ANALISIS = ['Sub-lote:', 'Área (ha):', 'Tipo:', 'NDVI:', 'Biomasa (kg/ha):', 'EV/ha:', 'Días:']
+ESTILO_POTRERO = {'fillColor': 'blue', 'color': 'blue', 'weight': 2, 'fillOpacity': 0.1}
+LEYENDA_TIPO_SUPERFICIE = [mpatches.Patch(color=color, label=label) for label, color in COLORES_TIPO_SUPERFICIE.items()]
+
+def asignar_colores_analisis(gdf_analizado, tipo_visualizacion):
+    """Devuelve el color de relleno de cada sub-lote según el tipo de visualización"""
+    if tipo_visualizacion == "tipo_superficie":
+        if 'tipo_superficie' not in gdf_analizado.columns:
+            return pd.Series(COLORES_TIPO_SUPERFICIE['VEGETACION_ESCASA'], index=gdf_analizado.index)
+        return gdf_analizado['tipo_superficie'].map(COLORES_TIPO_SUPERFICIE).fillna('#cccccc')
+    columna, cortes = CORTES_ANALISIS.get(tipo_visualizacion, CORTES_ANALISIS["ev_ha"])
+    if columna not in gdf_analizado.columns:
+        return pd.Series(PALETA_ANALISIS[0], index=gdf_analizado.index)
+    valores = pd.to_numeric(gdf_analizado[columna], errors='coerce').fillna(0).to_numpy()
+    return pd.Series(PALETA_ANALISIS[np.digitize(valores, cortes)], index=gdf_analizado.index)
+
+def simplificar_para_mapa(gdf, bounds, columnas=()):
+    """Prepara el payload del mapa: solo las columnas indicadas, geometrías simplificadas a la
+       resolución del mapa (~1600 px de ancho) y coordenadas cuantizadas (menos dígitos en el JSON)"""
+    tolerancia = max((bounds[2] - bounds[0]) / 1600, 1e-5)
+    simplificadas = gdf.geometry.simplify(tolerancia, preserve_topology=True)
+    cuantizadas = shapely.set_precision(simplificadas.values, tolerancia / 10)
+    return gpd.GeoDataFrame(gdf[list(columnas)], geometry=cuantizadas, index=gdf.index, crs=gdf.crs)
+
+@st.cache_resource(show_spinner=False, max_entries=32, hash_funcs={gpd.GeoDataFrame: hash_gdf})
+def crear_mapa_interactivo_base(gdf, base_map_name="ESRI Satélite"):
+    """Crea un mapa base interactivo con ESRI"""
+    if not FOLIUM_AVAILABLE or gdf is None or len(gdf)==0:
+        return None
+    
+    bounds = gdf.total_bounds
+    # Mapa base ESRI; el centro inicial sale de los límites (fit_bounds ajusta la vista final)
+    m = crear_mapa_esri(base_map_name, bounds, zoom_start=12)
     
     # Añadir el polígono principal
     folium.GeoJson(
-        gdf.__geo_interface__, 
+        simplificar_para_mapa(gdf, bounds).to_json(drop_id=True),
         name='Potrero',
-        style_function=lambda feature: {
-            'fillColor': 'blue',
-            'color': 'blue',
-            'weight': 2,
-            'fillOpacity': 0.1
-        },
+        style_function=lambda feature: ESTILO_POTRERO,
         tooltip=folium.GeoJsonTooltip(fields=[], aliases=[], labels=True)
     ).add_to(m)
     
@@ -546,85 +781,32 @@ def crear_mapa_interactivo_base(gdf, base_map_name="ESRI Satélite"):
     folium.LayerControl().add_to(m)
     return m
 
+@st.cache_resource(show_spinner=False, max_entries=32, hash_funcs={gpd.GeoDataFrame: hash_gdf})
 def crear_mapa_interactivo_analisis(gdf_analizado, base_map_name="ESRI Satélite", tipo_visualizacion="biomasa"):
     """Crea un mapa interactivo con los resultados del análisis superpuestos sobre ESRI"""
     if not FOLIUM_AVAILABLE or gdf_analizado is None or len(gdf_analizado)==0:
         return None
     
     bounds = gdf_analizado.total_bounds
-    centroid = gdf_analizado.geometry.centroid.iloc[0]
-    m = folium.Map(location=[centroid.y, centroid.x], tiles=None, control_scale=True, zoom_start=13)
-    
-    # Añadir mapa base ESRI
-    tiles_config = obtener_tiles_esri(base_map_name)
-    folium.TileLayer(
-        tiles=tiles_config["url"],
-        attr=tiles_config["attr"],
-        name=base_map_name
-    ).add_to(m)
+    m = crear_mapa_esri(base_map_name, bounds, zoom_start=13)
     
-    # Definir colores según el tipo de visualización
-    def get_color_by_analysis(feature, tipo_visualizacion):
-        if tipo_visualizacion == "biomasa":
-            biom = feature['properties'].get('biomasa_disponible_kg_ms_ha', 0)
-            if biom < 200:
-                return '#d73027'
-            elif biom < 600:
-                return '#fdae61'
-            elif biom < 1200:
-                return '#fee08b'
-            elif biom < 2000:
-                return '#a6d96a'
-            else:
-                return '#1a9850'
-        elif tipo_visualizacion == "ndvi":
-            ndvi = feature['properties'].get('ndvi', 0)
-            if ndvi < 0.2:
-                return '#d73027'
-            elif ndvi < 0.4:
-                return '#fdae61'
-            elif ndvi < 0.6:
-                return '#fee08b'
-            elif ndvi < 0.7:
-                return '#a6d96a'
-            else:
-                return '#1a9850'
-        elif tipo_visualizacion == "tipo_superficie":
-            tipo = feature['properties'].get('tipo_superficie', 'VEGETACION_ESCASA')
-            colores = {
-                'SUELO_DESNUDO': '#d73027',
-                'SUELO_PARCIAL': '#fdae61',
-                'VEGETACION_ESCASA': '#fee08b',
-                'VEGETACION_MODERADA': '#a6d96a',
-                'VEGETACION_DENSA': '#1a9850'
-            }
-            return colores.get(tipo, '#cccccc')
-        else:  # ev_ha
-            ev_ha = feature['properties'].get('ev_ha', 0)
-            if ev_ha < 0.5:
-                return '#d73027'
-            elif ev_ha < 1.0:
-                return '#fdae61'
-            elif ev_ha < 1.5:
-                return '#fee08b'
-            elif ev_ha < 2.0:
-                return '#a6d96a'
-            else:
-                return '#1a9850'
+    # Colores precalculados por sub-lote (una sola operación vectorizada)
+    gdf_mapa = simplificar_para_mapa(gdf_analizado, bounds, CAMPOS_TOOLTIP_ANALISIS)
+    gdf_mapa['_color'] = asignar_colores_analisis(gdf_analizado, tipo_visualizacion)
     
     # Añadir sub-lotes con colores según análisis
     folium.GeoJson(
-        gdf_analizado.__geo_interface__,
+        gdf_mapa.to_json(drop_id=True),
         name=f'Análisis - {tipo_visualizacion.title()}',
         style_function=lambda feature: {
-            'fillColor': get_color_by_analysis(feature, tipo_visualizacion),
+            'fillColor': feature['properties']['_color'],
             'color': 'black',
             'weight': 1,
             'fillOpacity': 0.7
         },
         tooltip=folium.GeoJsonTooltip(
-            fields=['id_subLote', 'area_ha', 'tipo_superficie', 'ndvi', 'biomasa_disponible_kg_ms_ha', 'ev_ha', 'dias_permanencia'],
-            aliases=['Sub-lote:', 'Área (ha):', 'Tipo:', 'NDVI:', 'Biomasa (kg/ha):', 'EV/ha:', 'Días:'],
+            fields=CAMPOS_TOOLTIP_ANALISIS,
+            aliases=ALIAS_TOOLTIP_ANALISIS,
             localize=True
         )
     ).add_to(m)
@@ -633,81 +815,218 @@ def crear_mapa_interactivo_analisis(gdf_analizado, base_map_name="ESRI Satélite
     folium.LayerControl().add_to(m)
     return m
 
+def renderizar_mapa(m, width, height, key=None):
+    """Muestra un mapa cacheado sin mutarlo (folium agrega elementos en cada render).
+       Con key, solo devuelve el último clic y guarda el nuevo en 'clic_mapa' (para inspeccionar
+       el sub-lote); el mapa es siempre el mismo, así el componente no se vuelve a montar.
+       Sin key el mapa es solo de vista: no devuelve nada, así mover o hacer zoom no dispara reruns."""
+    if key is None:
+        return st_folium(copy.deepcopy(m), width=width, height=height, returned_objects=[])
+    # La generación va en la key del componente: con cada resultado nuevo el mapa se monta de cero
+    # y no devuelve el last_clicked de un resultado anterior
+    salida = st_folium(copy.deepcopy(m), width=width, height=height,
+                       key=f"{key}_{st.session_state.get('generacion_mapas', 0)}",
+                       returned_objects=['last_clicked'])
+    if salida:
+        clic = salida.get('last_clicked')
+        if clic and clic != st.session_state.get(f"clic_{key}"):
+            st.session_state[f"clic_{key}"] = clic
+            st.session_state["clic_mapa"] = clic
+    return salida
+
+def olvidar_clics_mapa():
+    """Descarta los clics guardados (del resultado o archivo anterior) y renueva los componentes de mapa"""
+    for clave in [k for k in st.session_state.keys() if k == "clic_mapa" or k.startswith("clic_")]:
+        del st.session_state[clave]
+    st.session_state["generacion_mapas"] = st.session_state.get("generacion_mapas", 0) + 1
+
+def sublote_en_punto(gdf, lon, lat):
+    """Sub-lote que contiene el punto, consultando el R-tree (sindex) en lugar de recorrer todas las filas"""
+    idx = gdf.sindex.query(shapely.Point(lon, lat), predicate='intersects')
+    return gdf.iloc[idx[:1]] if len(idx) else None
+
+@st.fragment
+def mostrar_mapas_analisis(gdf_analizado, base_map_name):
+    """Mapas interactivos de resultados. Al ser un fragmento, interactuar con los mapas
+       solo re-ejecuta esta sección y no el resto de la página."""
+    st.markdown("#### 📊 Visualizaciones Interactivas sobre ESRI")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**🌱 Biomasa Disponible**")
+        mapa_biomasa = crear_mapa_interactivo_analisis(gdf_analizado, base_map_name, "biomasa")
+        if mapa_biomasa:
+            renderizar_mapa(mapa_biomasa, width=400, height=300, key="mapa_biomasa")
+        
+        st.markdown("**📈 NDVI**")
+        mapa_ndvi = crear_mapa_interactivo_analisis(gdf_analizado, base_map_name, "ndvi")
+        if mapa_ndvi:
+            renderizar_mapa(mapa_ndvi, width=400, height=300, key="mapa_ndvi")
+    
+    with col2:
+        st.markdown("**🏞️ Tipo de Superficie**")
+        mapa_tipo = crear_mapa_interactivo_analisis(gdf_analizado, base_map_name, "tipo_superficie")
+        if mapa_tipo:
+            renderizar_mapa(mapa_tipo, width=400, height=300, key="mapa_tipo")
+        
+        st.markdown("**🐄 EV por Hectárea**")
+        mapa_ev = crear_mapa_interactivo_analisis(gdf_analizado, base_map_name, "ev_ha")
+        if mapa_ev:
+            renderizar_mapa(mapa_ev, width=400, height=300, key="mapa_ev")
+
+    clic = st.session_state.get("clic_mapa")
+    if clic:
+        gdf_consulta = obtener_gdf_analizado()
+        sublote = sublote_en_punto(gdf_consulta if gdf_consulta is not None else gdf_analizado,
+                                   clic['lng'], clic['lat'])
+        if sublote is not None:
+            st.markdown("**🔎 Sub-lote seleccionado en el mapa**")
+            st.dataframe(tabla_resultados(sublote), hide_index=True, use_container_width=True)
+
+VISTAS_PYDECK = {
+    "🌱 Biomasa Disponible": "biomasa",
+    "📈 NDVI": "ndvi",
+    "🏞️ Tipo de Superficie": "tipo_superficie",
+    "🐄 EV por Hectárea": "ev_ha"
+}
+
+@st.fragment
+def mostrar_mapa_pydeck(gdf_analizado):
+    """Vista única de los sub-lotes con pydeck (WebGL) cuando folium no está instalado;
+       la variable a colorear se elige con un radio button."""
+    vista = st.radio("Variable:", list(VISTAS_PYDECK), horizontal=True, key="vista_pydeck")
+    colores = asignar_colores_analisis(gdf_analizado, VISTAS_PYDECK[vista])
+    rgb = colores.map(lambda h: [int(h[i:i+2], 16) for i in (1, 3, 5)])
+    # Mismo payload reducido que los mapas folium: columnas del tooltip y geometría simplificada
+    campos = [c for c in CAMPOS_TOOLTIP_ANALISIS if c in gdf_analizado.columns]
+    gdf_poligonos = (simplificar_para_mapa(gdf_analizado, gdf_analizado.total_bounds, campos)
+                     .assign(_rgb=rgb).explode(index_parts=False))
+    # El recorte puede dejar colecciones con líneas o puntos: solo se dibujan las partes poligonales
+    gdf_poligonos = gdf_poligonos[shapely.get_type_id(gdf_poligonos.geometry.values) == 3]
+    datos = pd.DataFrame({
+        'poligono': [[list(map(list, anillo.coords)) for anillo in [g.exterior, *g.interiors]]
+                     for g in gdf_poligonos.geometry],
+        '_rgb': gdf_poligonos['_rgb'].to_numpy(),
+        **{c: gdf_poligonos[c].to_numpy() for c in campos}
+    })
+    minx, miny, maxx, maxy = gdf_analizado.total_bounds
+    capa = pdk.Layer("PolygonLayer", data=datos, get_polygon="poligono", get_fill_color="_rgb",
+                     get_line_color=[0, 0, 0], line_width_min_pixels=1, opacity=0.7, pickable=True)
+    tooltip = {"html": "<br/>".join(f"{alias} {{{campo}}}" for campo, alias
+                                    in zip(CAMPOS_TOOLTIP_ANALISIS, ALIAS_TOOLTIP_ANALISIS))}
+    st.pydeck_chart(pdk.Deck(layers=[capa], tooltip=tooltip,
+                             initial_view_state=pdk.ViewState(latitude=(miny + maxy) / 2,
+                                                              longitude=(minx + maxx) / 2, zoom=13)),
+                    use_container_width=True)
+
 # -----------------------
 # MAPAS MATPLOTLIB (para informe)
 # -----------------------
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={gpd.GeoDataFrame: hash_gdf})
 def crear_mapa_detallado_vegetacion(gdf_analizado, tipo_pastura):
+    """Figura de 4 mapas (PNG en bytes). Cacheada por geometría/atributos y tipo de pastura:
+       con las mismas entradas no se vuelve a dibujar ni a codificar."""
     try:
         fig, axes = plt.subplots(2, 2, figsize=(20, 16))
         ax1, ax2, ax3, ax4 = axes[0, 0], axes[0, 1], axes[1, 0], axes[1, 1]
+        # Centroides de las etiquetas, calculados una sola vez para los cuatro mapas
+        centroides = gdf_analizado.geometry.centroid
+        cx = centroides.x.to_numpy()
+        cy = centroides.y.to_numpy()
+        # Para dibujar alcanza con la geometría simplificada a la resolución de la figura
+        gdf_dibujo = simplificar_para_mapa(gdf_analizado, gdf_analizado.total_bounds)
         
-        # Mapa 1: Tipos de Superficie
-        colores_superficie = {
-            'SUELO_DESNUDO': '#d73027',
-            'SUELO_PARCIAL': '#fdae61',
-            'VEGETACION_ESCASA': '#fee08b',
-            'VEGETACION_MODERADA': '#a6d96a',
-            'VEGETACION_DENSA': '#1a9850'
-        }
-        for idx, row in gdf_analizado.iterrows():
-            tipo = row.get('tipo_superficie', 'VEGETACION_ESCASA')
-            color = colores_superficie.get(tipo, '#cccccc')
-            gdf_analizado.iloc[[idx]].plot(ax=ax1, color=color, edgecolor='black', linewidth=0.5)
-            c = row.geometry.centroid
-            ax1.text(c.x, c.y, f"S{row['id_subLote']}", fontsize=6, ha='center', va='center')
+        n = len(gdf_analizado)
+        def columna(nombre, defecto):
+            return gdf_analizado[nombre].to_numpy() if nombre in gdf_analizado.columns else np.full(n, defecto)
+
+        def etiquetar(ax, textos):
+            for x, y, t in zip(cx, cy, textos):
+                ax.text(x, y, t, fontsize=6, ha='center', va='center')
+
+        # Mapa 1: Tipos de Superficie (todos los polígonos en una sola llamada a plot)
+        tipos = pd.Series(columna('tipo_superficie', 'VEGETACION_ESCASA'))
+        colores = tipos.map(COLORES_TIPO_SUPERFICIE).fillna('#cccccc').tolist()
+        gdf_dibujo.plot(ax=ax1, color=colores, edgecolor='black', linewidth=0.5)
+        etiquetar(ax1, [f"S{i}" for i in columna('id_subLote', 0)])
         ax1.set_title(f"Tipos de Superficie - {tipo_pastura}", fontsize=14, fontweight='bold')
         
         # Leyenda para tipos de superficie
-        patches = [mpatches.Patch(color=color, label=label) for label, color in colores_superficie.items()]
-        ax1.legend(handles=patches, loc='upper right', fontsize=8)
+        ax1.legend(handles=LEYENDA_TIPO_SUPERFICIE, loc='upper right', fontsize=8)
 
         # Mapa 2: Biomasa Disponible
         cmap_biomasa = LinearSegmentedColormap.from_list('biomasa_cmap', ['#d73027','#fee08b','#a6d96a','#1a9850'])
-        for idx, row in gdf_analizado.iterrows():
-            biom = row.get('biomasa_disponible_kg_ms_ha', 0)
-            val = max(0, min(1, biom/4000))
-            color = cmap_biomasa(val)
-            gdf_analizado.iloc[[idx]].plot(ax=ax2, color=color, edgecolor='black', linewidth=0.5)
-            c = row.geometry.centroid
-            ax2.text(c.x, c.y, f"{biom:.0f}", fontsize=6, ha='center', va='center')
+        biom = columna('biomasa_disponible_kg_ms_ha', 0)
+        gdf_dibujo.plot(ax=ax2, color=cmap_biomasa(np.clip(biom / 4000, 0, 1)), edgecolor='black', linewidth=0.5)
+        etiquetar(ax2, [f"{v:.0f}" for v in biom])
         ax2.set_title("Biomasa Disponible (kg MS/ha)", fontsize=14, fontweight='bold')
 
         # Mapa 3: EV por Hectárea
         cmap_ev = LinearSegmentedColormap.from_list('ev_cmap', ['#d73027','#fee08b','#a6d96a','#1a9850'])
-        for idx, row in gdf_analizado.iterrows():
-            ev_ha = row.get('ev_ha', 0)
-            val = max(0, min(1, ev_ha/2.0))
-            color = cmap_ev(val)
-            gdf_analizado.iloc[[idx]].plot(ax=ax3, color=color, edgecolor='black', linewidth=0.5)
-            c = row.geometry.centroid
-            ax3.text(c.x, c.y, f"{ev_ha:.2f}", fontsize=6, ha='center', va='center')
+        ev_ha = columna('ev_ha', 0)
+        gdf_dibujo.plot(ax=ax3, color=cmap_ev(np.clip(ev_ha / 2.0, 0, 1)), edgecolor='black', linewidth=0.5)
+        etiquetar(ax3, [f"{v:.2f}" for v in ev_ha])
         ax3.set_title("Equivalente Vaca por Hectárea (EV/ha)", fontsize=14, fontweight='bold')
 
         # Mapa 4: Días de Permanencia
         cmap_dias = LinearSegmentedColormap.from_list('dias_cmap', ['#d73027','#fee08b','#a6d96a','#1a9850'])
-        for idx, row in gdf_analizado.iterrows():
-            dias = row.get('dias_permanencia', 0)
-            val = max(0, min(1, dias/60.0))
-            color = cmap_dias(val)
-            gdf_analizado.iloc[[idx]].plot(ax=ax4, color=color, edgecolor='black', linewidth=0.5)
-            c = row.geometry.centroid
-            ax4.text(c.x, c.y, f"{dias:.0f}", fontsize=6, ha='center', va='center')
+        dias = columna('dias_permanencia', 0)
+        gdf_dibujo.plot(ax=ax4, color=cmap_dias(np.clip(dias / 60.0, 0, 1)), edgecolor='black', linewidth=0.5)
+        etiquetar(ax4, [f"{v:.0f}" for v in dias])
         ax4.set_title("Días de Permanencia", fontsize=14, fontweight='bold')
 
         plt.tight_layout()
         buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-        buf.seek(0)
+        plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
         plt.close(fig)
-        return buf
+        return buf.getvalue()
     except Exception as e:
         st.error(f"❌ Error creando mapa detallado: {e}")
         return None
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def miniatura_png(png_bytes, ancho_max=1200):
+    """Versión reducida del PNG para mostrar en pantalla (el informe usa el original a resolución completa).
+       Se cuantiza a paleta de 256 colores: el remuestreo agrega colores y sin paleta el PNG pesa más que el original."""
+    imagen = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+    imagen.thumbnail((ancho_max, ancho_max))
+    buf = io.BytesIO()
+    imagen.quantize(256).save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+# -----------------------
+# EXPORTES
+# -----------------------
+# Columnas de la tabla de resultados (app e informe) y sus encabezados legibles
+COLUMNAS_DETALLE = ['id_subLote', 'area_ha', 'tipo_superficie', 'ndvi', 'cobertura_vegetal',
+                    'biomasa_disponible_kg_ms_ha', 'ev_ha', 'dias_permanencia']
+ENCABEZADOS_DETALLE = {c: c.replace('_',' ').title() for c in COLUMNAS_DETALLE}
+
+def tabla_resultados(gdf):
+    """Tabla de resultados para mostrar, armada directamente con los arrays de cada columna (sin copiar el GeoDataFrame)"""
+    return pd.DataFrame({ENCABEZADOS_DETALLE[c]: gdf[c].to_numpy() for c in COLUMNAS_DETALLE if c in gdf.columns},
+                        copy=False)
+
+def exportar_csv(df):
+    """Serializa una tabla a CSV (bytes UTF-8). Se usa el escritor de pandas: el de PyArrow entrecomilla
+       encabezados y textos y escribe 1200.0 como 1200, lo que cambiaría el archivo exportado."""
+    return df.to_csv(index=False).encode('utf-8')
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={gpd.GeoDataFrame: hash_gdf})
+def exportar_geojson_cacheado(gdf):
+    """GeoJSON de los resultados; se serializa una sola vez por GeoDataFrame (los reruns reutilizan el texto)"""
+    return gdf.to_json(drop_id=True)
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={gpd.GeoDataFrame: hash_gdf})
+def exportar_csv_cacheado(gdf):
+    """CSV de los atributos de los resultados, cacheado igual que el GeoJSON"""
+    return exportar_csv(gdf.drop(columns=['geometry']))
+
 # -----------------------
 # GENERAR INFORME DOCX
 # -----------------------
-def generar_informe_forrajero_docx(gdf, tipo_pastura, peso_promedio, carga_animal, fecha_imagen):
+def generar_informe_forrajero_docx(gdf, tipo_pastura, peso_promedio, carga_animal, fecha_imagen,
+                                   fuente_datos, mapa_bytes=None):
     """Genera y devuelve un BytesIO con el DOCX que contiene el análisis y
        las secciones: técnico + orientaciones prácticas (ganadería regenerativa)."""
     if not DOCX_AVAILABLE:
@@ -719,7 +1038,7 @@ def generar_informe_forrajero_docx(gdf, tipo_pastura, peso_promedio, carga_anima
         doc.add_heading(titulo, level=0)
         doc.add_paragraph(f"Generado: {datetime.now().strftime('%d/%m/%Y %H:%M')}")
         doc.add_paragraph(f"Tipo de pastura: {tipo_pastura}")
-        doc.add_paragraph(f"Fuente de datos: {fuente_satelital}")
+        doc.add_paragraph(f"Fuente de datos: {fuente_datos}")
         doc.add_paragraph(f"Peso promedio animal: {peso_promedio} kg")
         doc.add_paragraph(f"Carga animal: {carga_animal} cabezas")
         doc.add_paragraph("")
@@ -746,48 +1065,34 @@ def generar_informe_forrajero_docx(gdf, tipo_pastura, peso_promedio, carga_anima
 
         # Tabla resumen por sub-lote (primeras 20)
         doc.add_heading("Resultados por Sub-lote (primeras 20 filas)", level=1)
-        columnas = ['id_subLote', 'area_ha', 'tipo_superficie', 'ndvi', 'cobertura_vegetal',
-                   'biomasa_disponible_kg_ms_ha', 'ev_ha', 'dias_permanencia']
-        cols_presentes = [c for c in columnas if c in gdf.columns]
-        table = doc.add_table(rows=1, cols=len(cols_presentes))
+        cols_presentes = [c for c in COLUMNAS_DETALLE if c in gdf.columns]
+        # Textos de todas las celdas en una sola conversión y la tabla creada
+        # ya con todas sus filas (sin add_row() por fila)
+        primeras = gdf.head(20)[cols_presentes]
+        textos = primeras.astype(str).where(primeras.notna(), '').to_numpy()
+        table = doc.add_table(rows=len(textos) + 1, cols=len(cols_presentes))
         hdr = table.rows[0].cells
         for i, c in enumerate(cols_presentes):
-            hdr[i].text = c.replace('_',' ').title()
-        for _, row in gdf.head(20).iterrows():
-            r = table.add_row().cells
-            for i, c in enumerate(cols_presentes):
-                val = row.get(c, '')
-                if pd.isna(val):
-                    val = ''
-                r[i].text = str(val)
+            hdr[i].text = ENCABEZADOS_DETALLE[c]
+        for fila_tabla, fila in zip(table.rows[1:], textos):
+            for celda, texto in zip(fila_tabla.cells, fila):
+                celda.text = texto
         doc.add_paragraph(f"Mostrando {min(20,len(gdf))} de {len(gdf)} sub-lotes.")
         doc.add_paragraph("")
 
         # Inserción del mapa (si existe)
-        if st.session_state.mapa_detallado_bytes is not None:
+        if mapa_bytes is not None:
+            # python-docx acepta el PNG en memoria: sin archivo temporal
+            doc.add_page_break()
+            doc.add_heading("Mapa Detallado de Análisis", level=1)
             try:
-                img_buf = st.session_state.mapa_detallado_bytes
-                img_buf.seek(0)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_img:
-                    tmp_img.write(img_buf.read())
-                    tmp_img.flush()
-                    tmp_path = tmp_img.name
-                doc.add_page_break()
-                doc.add_heading("Mapa Detallado de Análisis", level=1)
-                try:
-                    doc.add_picture(tmp_path, width=Inches(6))
-                except Exception:
-                    # Si no se puede insertar a tamaño, insertar sin width
-                    try:
-                        doc.add_picture(tmp_path)
-                    except Exception:
-                        pass
+                doc.add_picture(io.BytesIO(mapa_bytes), width=Inches(6))
+            except Exception:
+                # Si no se puede insertar a tamaño, insertar sin width
                 try:
-                    os.remove(tmp_path)
+                    doc.add_picture(io.BytesIO(mapa_bytes))
                 except Exception:
                     pass
-            except Exception:
-                pass
 
         # Conclusión breve
         doc.add_heading("Conclusión", level=1)
@@ -866,6 +1171,15 @@ def generar_informe_forrajero_docx(gdf, tipo_pastura, peso_promedio, carga_anima
         st.error(f"❌ Error generando informe DOCX: {e}")
         return None
 
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={gpd.GeoDataFrame: hash_gdf})
+def generar_informe_docx_cacheado(gdf, tipo_pastura, peso_promedio, carga_animal, fecha_imagen,
+                                  fuente_datos, mapa_bytes):
+    """Bytes del informe DOCX; se arma una sola vez por resultado y parámetros del informe"""
+    buf = generar_informe_forrajero_docx(gdf, tipo_pastura, peso_promedio, carga_animal, fecha_imagen,
+                                         fuente_datos, mapa_bytes)
+    return None if buf is None else buf.getvalue()
+
 # -----------------------
 # FLUJO PRINCIPAL: carga, análisis, exportes
 # -----------------------
@@ -876,13 +1190,22 @@ gdf_loaded = None
 if uploaded_file is not None:
     with st.spinner("Cargando archivo..."):
         try:
-            if tipo_archivo == "Shapefile (ZIP)":
+            # El archivo se lee y su superficie se calcula solo cuando cambia; en los reruns se reutiliza
+            huella = hashlib.md5(uploaded_file.getvalue()).hexdigest()
+            if st.session_state.huella_archivo == huella and st.session_state.gdf_cargado is not None:
+                gdf_loaded = obtener_gdf_cargado()
+            elif tipo_archivo == "Shapefile (ZIP)":
                 gdf_loaded = cargar_shapefile_desde_zip(uploaded_file)
             else:
                 gdf_loaded = cargar_kml(uploaded_file)
             if gdf_loaded is not None and len(gdf_loaded) > 0:
-                st.session_state.gdf_cargado = gdf_loaded
-                area_total = calcular_superficie(gdf_loaded).sum()
+                if st.session_state.huella_archivo != huella or st.session_state.area_total_ha is None:
+                    st.session_state.gdf_cargado = empaquetar_gdf(gdf_loaded)
+                    st.session_state.area_total_ha = float(calcular_superficie(gdf_loaded).sum())
+                    if st.session_state.huella_archivo != huella:
+                        olvidar_clics_mapa()
+                    st.session_state.huella_archivo = huella
+                area_total = st.session_state.area_total_ha
                 st.success("✅ Archivo cargado correctamente.")
                 col1,col2,col3,col4 = st.columns(4)
                 with col1: st.metric("Polígonos", len(gdf_loaded))
@@ -894,7 +1217,7 @@ if uploaded_file is not None:
                     st.markdown("### 🗺️ Visualización del potrero (interactiva)")
                     m = crear_mapa_interactivo_base(gdf_loaded, base_map_option)
                     if m:
-                        st_folium(m, width=1200, height=500)
+                        renderizar_mapa(m, width=1200, height=500)
                 else:
                     st.info("Instalá folium y streamlit-folium para ver el mapa interactivo: pip install folium streamlit-folium")
             else:
@@ -909,159 +1232,99 @@ if st.session_state.gdf_cargado is not None:
     
     # Botón de análisis PRINCIPAL
     if st.button("🚀 Ejecutar Análisis Forrajero (Realista)", type="primary", key="analisis_principal"):
+        # El clic ya provocó este rerun: los resultados se muestran más abajo en esta misma pasada
         st.session_state.analisis_ejecutado = True
         st.session_state.mostrar_resultados = True
-        st.rerun()
     
     # Mostrar resultados solo si el análisis fue ejecutado
     if st.session_state.get('analisis_ejecutado', False) and st.session_state.get('mostrar_resultados', False):
         with st.spinner("Ejecutando análisis forrajero completo..."):
             try:
-                gdf_input = st.session_state.gdf_cargado.copy()
-                
-                # 1. Dividir potrero en sub-lotes
-                st.info("📐 Dividiendo potrero en sub-lotes...")
-                gdf_sub = dividir_potrero_en_subLotes(gdf_input, n_divisiones)
-                if gdf_sub is None or len(gdf_sub)==0:
-                    st.error("No se pudo dividir el potrero en sub-lotes.")
+                parametros = tuple(sorted(obtener_parametros_forrajeros(tipo_pastura).items()))
+                gdf_sub, error_analisis = ejecutar_analisis_forrajero(
+                    obtener_gdf_cargado(), n_divisiones, forma_subLotes, tipo_pastura, parametros, fuente_satelital,
+                    fecha_imagen, nubes_max, umbral_ndvi_minimo, umbral_ndvi_optimo, sensibilidad_suelo,
+                    peso_promedio, carga_animal
+                )
+                if error_analisis:
+                    st.error(error_analisis)
                 else:
-                    # 2. Calcular áreas
-                    areas = calcular_superficie(gdf_sub)
-                    gdf_sub['area_ha'] = areas.values
+                    st.session_state.gdf_analizado = empaquetar_gdf(gdf_sub)
+                    olvidar_clics_mapa()
                     
-                    # 3. Calcular índices de vegetación
-                    st.info("🌿 Calculando índices de vegetación...")
-                    indices = calcular_indices_forrajeros_realista(gdf_sub, tipo_pastura, fuente_satelital, fecha_imagen, nubes_max,
-                                                                  umbral_ndvi_minimo, umbral_ndvi_optimo, sensibilidad_suelo)
-                    if not indices:
-                        st.error("No se pudieron calcular índices (indices vacío).")
-                    else:
-                        # 4. Agregar índices al GeoDataFrame
-                        for idx, rec in enumerate(indices):
-                            for k,v in rec.items():
-                                if k != 'id_subLote':
-                                    try:
-                                        gdf_sub.loc[gdf_sub.index[idx], k] = v
-                                    except Exception:
-                                        pass
-                        
-                        # 5. Calcular métricas ganaderas
-                        st.info("🐄 Calculando métricas ganaderas...")
-                        metricas = calcular_metricas_ganaderas(gdf_sub, tipo_pastura, peso_promedio, carga_animal)
-                        for idx, met in enumerate(metricas):
-                            for k,v in met.items():
-                                try:
-                                    gdf_sub.loc[gdf_sub.index[idx], k] = v
-                                except Exception:
-                                    pass
-                        
-                        st.session_state.gdf_analizado = gdf_sub
-                        
-                        # 6. Crear y mostrar mapas
-                        st.markdown("---")
-                        st.markdown("### 🗺️ Mapas de Análisis")
-                        
-                        # Mapa detallado (Matplotlib)
-                        st.info("🗺️ Generando mapas detallados...")
-                        mapa_buf = crear_mapa_detallado_vegetacion(gdf_sub, tipo_pastura)
-                        if mapa_buf is not None:
-                            st.image(mapa_buf, use_column_width=True, caption="Mapas de Análisis: Tipos de Superficie, Biomasa Disponible, EV/ha y Días de Permanencia")
-                            st.session_state.mapa_detallado_bytes = mapa_buf
-                        
-                        # Mapas interactivos con ESRI
-                        if FOLIUM_AVAILABLE:
-                            st.markdown("#### 📊 Visualizaciones Interactivas sobre ESRI")
-                            
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.markdown("**🌱 Biomasa Disponible**")
-                                mapa_biomasa = crear_mapa_interactivo_analisis(gdf_sub, base_map_option, "biomasa")
-                                if mapa_biomasa:
-                                    st_folium(mapa_biomasa, width=400, height=300)
-                                
-                                st.markdown("**📈 NDVI**")
-                                mapa_ndvi = crear_mapa_interactivo_analisis(gdf_sub, base_map_option, "ndvi")
-                                if mapa_ndvi:
-                                    st_folium(mapa_ndvi, width=400, height=300)
-                            
-                            with col2:
-                                st.markdown("**🏞️ Tipo de Superficie**")
-                                mapa_tipo = crear_mapa_interactivo_analisis(gdf_sub, base_map_option, "tipo_superficie")
-                                if mapa_tipo:
-                                    st_folium(mapa_tipo, width=400, height=300)
-                                
-                                st.markdown("**🐄 EV por Hectárea**")
-                                mapa_ev = crear_mapa_interactivo_analisis(gdf_sub, base_map_option, "ev_ha")
-                                if mapa_ev:
-                                    st_folium(mapa_ev, width=400, height=300)
-                        
-                        # 7. Exportar resultados
-                        st.markdown("---")
-                        st.markdown("### 📤 Exportar Resultados")
-                        col_export1, col_export2 = st.columns(2)
-                        with col_export1:
-                            try:
-                                geojson_str = gdf_sub.to_json()
-                                st.download_button("📤 Exportar GeoJSON", geojson_str,
-                                                   f"analisis_{tipo_pastura}_{datetime.now().strftime('%Y%m%d_%H%M')}.geojson",
-                                                   "application/geo+json")
-                            except Exception as e:
-                                st.error(f"Error exportando GeoJSON: {e}")
-                        with col_export2:
-                            try:
-                                csv_bytes = gdf_sub.drop(columns=['geometry']).to_csv(index=False).encode('utf-8')
-                                st.download_button("📊 Exportar CSV", csv_bytes,
-                                                   f"analisis_{tipo_pastura}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
-                                                   "text/csv")
-                            except Exception as e:
-                                st.error(f"Error exportando CSV: {e}")
-                        
-                        # 8. Mostrar tabla de resultados
-                        st.markdown("---")
-                        st.markdown("### 📊 Tabla de Resultados")
+                    # 6. Crear y mostrar mapas
+                    st.markdown("---")
+                    st.markdown("### 🗺️ Mapas de Análisis")
+                    
+                    # Mapa detallado (Matplotlib)
+                    st.info("🗺️ Generando mapas detallados...")
+                    mapa_buf = crear_mapa_detallado_vegetacion(gdf_sub, tipo_pastura)
+                    if mapa_buf is not None:
+                        st.image(miniatura_png(mapa_buf), use_container_width=True, caption="Mapas de Análisis: Tipos de Superficie, Biomasa Disponible, EV/ha y Días de Permanencia")
+                        st.session_state.mapa_detallado_bytes = mapa_buf
+                    
+                    # Mapas interactivos con ESRI
+                    if FOLIUM_AVAILABLE:
+                        mostrar_mapas_analisis(gdf_sub, base_map_option)
+                    elif PYDECK_AVAILABLE:
+                        mostrar_mapa_pydeck(gdf_sub)
+                    
+                    # 7. Exportar resultados
+                    st.markdown("---")
+                    st.markdown("### 📤 Exportar Resultados")
+                    # Una sola marca de tiempo para que todos los exportes compartan nombre
+                    sello = datetime.now().strftime('%Y%m%d_%H%M')
+                    # on_click="ignore": descargar no re-ejecuta el script (los resultados siguen en pantalla)
+                    col_export1, col_export2 = st.columns(2)
+                    with col_export1:
+                        try:
+                            geojson_str = exportar_geojson_cacheado(gdf_sub)
+                            st.download_button("📤 Exportar GeoJSON", geojson_str,
+                                               f"analisis_{tipo_pastura}_{sello}.geojson",
+                                               "application/geo+json", on_click="ignore")
+                        except Exception as e:
+                            st.error(f"Error exportando GeoJSON: {e}")
+                    with col_export2:
                         try:
-                            columnas_detalle = ['id_subLote', 'area_ha', 'tipo_superficie', 'ndvi', 'cobertura_vegetal',
-                                               'biomasa_disponible_kg_ms_ha', 'ev_ha', 'dias_permanencia']
-                            cols_presentes = [c for c in columnas_detalle if c in gdf_sub.columns]
-                            df_show = gdf_sub[cols_presentes].copy()
-                            df_show.columns = [c.replace('_',' ').title() for c in df_show.columns]
-                            st.dataframe(df_show, use_container_width=True)
-                        except Exception:
-                            st.info("No hay datos tabulares para mostrar.")
-                        
-                        # 9. Generar informe DOCX automáticamente
-                        if DOCX_AVAILABLE:
-                            st.info("📝 Generando informe DOCX...")
-                            docx_buf = generar_informe_forrajero_docx(gdf_sub, tipo_pastura, peso_promedio, carga_animal, fecha_imagen)
-                            if docx_buf is not None:
-                                st.session_state.docx_buffer = docx_buf
-                                b64 = base64.b64encode(docx_buf.getvalue()).decode()
-                                filename = f"informe_disponibilidad_forrajera_prv_{tipo_pastura}_{fecha_imagen.strftime('%Y%m')}.docx"
-                                html_download = f"""
-                                <html>
-                                <body>
-                                <a id='dlink' href='data:application/vnd.openxmlformats-officedocument.wordprocessingml.document;base64,{b64}' download='{filename}'>download</a>
-                                <script>
-                                    const d = document.getElementById('dlink');
-                                    d.click();
-                                </script>
-                                <p>Si la descarga automática no inició, <a href='data:application/vnd.openxmlformats-officedocument.wordprocessingml.document;base64,{b64}' download='{filename}'>hacé clic acá para descargar</a>.</p>
-                                </body>
-                                </html>
-                                """
-                                st.success("✅ Informe DOCX generado. Descarga automática iniciada (o hacé clic en el enlace).")
-                                components.html(html_download, height=140)
-                            else:
-                                st.error("❌ No se pudo generar el informe DOCX.")
+                            csv_bytes = exportar_csv_cacheado(gdf_sub)
+                            st.download_button("📊 Exportar CSV", csv_bytes,
+                                               f"analisis_{tipo_pastura}_{sello}.csv",
+                                               "text/csv", on_click="ignore")
+                        except Exception as e:
+                            st.error(f"Error exportando CSV: {e}")
+                    
+                    # 8. Mostrar tabla de resultados
+                    st.markdown("---")
+                    st.markdown("### 📊 Tabla de Resultados")
+                    try:
+                        st.dataframe(tabla_resultados(gdf_sub), use_container_width=True)
+                    except Exception:
+                        st.info("No hay datos tabulares para mostrar.")
+                    
+                    # 9. Generar informe DOCX
+                    if DOCX_AVAILABLE:
+                        st.info("📝 Generando informe DOCX...")
+                        docx_bytes = generar_informe_docx_cacheado(gdf_sub, tipo_pastura, peso_promedio, carga_animal,
+                                                                   fecha_imagen, fuente_satelital,
+                                                                   st.session_state.mapa_detallado_bytes)
+                        if docx_bytes is not None:
+                            st.session_state.docx_buffer = docx_bytes
+                            filename = f"informe_disponibilidad_forrajera_prv_{tipo_pastura}_{fecha_imagen.strftime('%Y%m')}.docx"
+                            st.success("✅ Informe DOCX generado.")
+                            st.download_button("📄 Descargar informe DOCX", docx_bytes, filename,
+                                               "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                                               key="dl_docx", on_click="ignore")
                         else:
-                            st.warning("python-docx no está instalado — no puedo generar DOCX. Ejecutá: pip install python-docx")
-                        
-                        st.session_state.analisis_completado = True
-                        st.success("🎉 ¡Análisis completado exitosamente!")
-                        
-                        # RESETEAR el estado para evitar bucles
-                        st.session_state.analisis_ejecutado = False
-                        
+                            st.error("❌ No se pudo generar el informe DOCX.")
+                    else:
+                        st.warning("python-docx no está instalado — no puedo generar DOCX. Ejecutá: pip install python-docx")
+                    
+                    st.session_state.analisis_completado = True
+                    st.success("🎉 ¡Análisis completado exitosamente!")
+                    
+                    # RESETEAR el estado para evitar bucles
+                    st.session_state.analisis_ejecutado = False
+                    
             except Exception as e:
                 st.error(f"❌ Error ejecutando análisis: {e}")
                 import traceback
@@ -1072,5 +1335,5 @@ else:
 # Mensaje final / instrucciones
 st.markdown("---")
 st.markdown("**Notas:**")
-st.markdown("- Si la descarga automática no inicia por políticas del navegador, usá el enlace que aparece debajo del mensaje de éxito para descargar el .docx manualmente.")
+st.markdown("- El informe .docx se descarga con el botón que aparece debajo del mensaje de éxito.")
 st.markdown("- Para convertir a PDF, abrí el .docx y guardá como PDF o usá tu conversor preferido.")